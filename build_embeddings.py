@@ -5,61 +5,181 @@ Processes all .md files in /docs and creates corresponding .json files in /embed
 """
 
 import os
-import json
+import mmap
 import hashlib
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
-from typing import Dict, List, Optional
+from typing import Dict, Iterator, List, Optional, Tuple
+import numpy as np
+import orjson
 import torch
 from transformers import AutoTokenizer, AutoModel
 
 
 class EmbeddingBuilder:
-    def __init__(self, docs_dir: str = "/docs", embeddings_dir: str = "/embeddings"):
+    def __init__(self, docs_dir: str = "/docs", embeddings_dir: str = "/embeddings", batch_size: int = 16,
+                 quantize_cpu: bool = False, cache_dir: Optional[str] = None):
         self.docs_dir = Path(docs_dir)
         self.embeddings_dir = Path(embeddings_dir)
         self.model_name = "intfloat/multilingual-e5-large"
+        self.batch_size = batch_size
+        self.max_length = 512
+        # Sequence widths batches are padded to on GPU, where the compiled model is specialized
+        # to each input shape: a few fixed buckets keep it to one compiled graph per bucket
+        self.width_buckets = (128, 256, self.max_length)
+        # Optional local cache of each markdown file's (mtime, size, shasum) from the last run,
+        # kept in its own directory so it never ends up next to the published embeddings
+        self.mtime_cache_path = Path(cache_dir) / "mtime-cache.json" if cache_dir else None
+        self.mtime_cache: Dict[str, Tuple[int, int, str]] = {}
+        
+        # Use GPU if available
+        self.device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
+        
+        # Load weights in half precision on GPU to halve memory traffic
+        if self.device.type == "cuda":
+            dtype = torch.bfloat16 if torch.cuda.is_bf16_supported() else torch.float16
+        else:
+            dtype = torch.float32
         
         print(f"Loading model: {self.model_name}")
-        self.tokenizer = AutoTokenizer.from_pretrained(self.model_name)
-        self.model = AutoModel.from_pretrained(self.model_name)
+        # The fast (Rust) tokenizer encodes batches in parallel
+        self.tokenizer = AutoTokenizer.from_pretrained(self.model_name, use_fast=True)
+        self.model = AutoModel.from_pretrained(self.model_name, torch_dtype=dtype)
+        # Token IDs of the "passage: " instruction prefix recommended for e5 models,
+        # tokenized once and inserted after the leading <s> token of every text
+        self.prefix_ids = self.tokenizer("passage:", add_special_tokens=False,
+                                         return_tensors="pt").input_ids[0]
         self.model.eval()
+        self.model.requires_grad_(False)
         
-        # Use GPU if available
-        self.device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
         self.model.to(self.device)
-        print(f"Using device: {self.device}")
+        print(f"Using device: {self.device} ({dtype})")
+        
+        # Compile the encoder so elementwise ops between matmuls get fused. Only done on GPU:
+        # the CPU backend needs a C++ compiler, which the slim Docker image does not ship.
+        if self.device.type == "cuda":
+            self.model = torch.compile(self.model, mode="reduce-overhead", dynamic=False)
+        elif quantize_cpu:
+            # Opt-in: quantize linear layers to int8 so CPU matmuls run on the VNNI/AVX2 int8 kernels.
+            # Faster, but the embeddings only approximate the fp32 ones.
+            print("Quantizing model to int8")
+            self.model = torch.ao.quantization.quantize_dynamic(
+                self.model, {torch.nn.Linear}, dtype=torch.qint8)
+    
+    def warmup(self, widths: List[int]) -> None:
+        """Run a throwaway batch at each of the given widths, so compilation and CUDA graph
+        capture for those input shapes happen before the first real batch."""
+        print("Warming up model")
+        for width in widths:
+            dummy = {
+                "input_ids": torch.full((self.batch_size, width), self.tokenizer.pad_token_id,
+                                        dtype=torch.long, device=self.device),
+                "attention_mask": torch.ones(self.batch_size, width, dtype=torch.long, device=self.device),
+            }
+            self.embed_batch(dummy)
+    
+    def bucket_width(self, length: int) -> int:
+        """Return the smallest width bucket that fits a sequence of the given length."""
+        return next(bucket for bucket in self.width_buckets if bucket >= length)
     
     def calculate_shasum(self, file_path: Path) -> str:
         """Calculate SHA256 hash of a file."""
-        sha256_hash = hashlib.sha256()
         with open(file_path, "rb") as f:
-            for byte_block in iter(lambda: f.read(4096), b""):
-                sha256_hash.update(byte_block)
+            if hasattr(hashlib, "file_digest"):
+                # Python 3.11+: stream the file through the hash entirely in C
+                sha256_hash = hashlib.file_digest(f, "sha256")
+            else:
+                # Older Pythons: hash the mapped file in a single update call (mmap cannot map empty files)
+                sha256_hash = hashlib.sha256()
+                if os.fstat(f.fileno()).st_size > 0:
+                    with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as buf:
+                        sha256_hash.update(buf)
         return sha256_hash.hexdigest()
     
-    def get_headline(self, file_path: Path) -> str:
-        """Extract the first line from the markdown file."""
+    def read_markdown_file(self, file_path: Path) -> Tuple[str, str]:
+        """Read a markdown file once and return its content and headline."""
         with open(file_path, "r", encoding="utf-8") as f:
-            first_line = f.readline().strip()
-        return first_line
+            content = f.read()
+        
+        # The first line is the headline; text mode already turned \r and \r\n into \n
+        headline = content.partition("\n")[0].strip()
+        return content, headline
     
-    def generate_embedding(self, text: str) -> List[float]:
-        """Generate embedding for the given text using multilingual-e5-large."""
-        # Add the instruction prefix as recommended for e5 models
-        text = f"passage: {text}"
+    def tokenize(self, texts: List[str]) -> Dict[str, torch.Tensor]:
+        """Tokenize all texts at once and prepend the instruction prefix."""
+        count = len(texts)
+        prefix_length = len(self.prefix_ids)
+        inputs = self.tokenizer(texts, return_tensors="pt", padding=True, truncation=True,
+                                max_length=self.max_length - prefix_length)
+        
+        # Insert the prefix IDs right after the leading <s> token
+        input_ids = torch.cat([inputs["input_ids"][:, :1],
+                               self.prefix_ids.expand(count, -1),
+                               inputs["input_ids"][:, 1:]], dim=1)
+        attention_mask = torch.cat([inputs["attention_mask"][:, :1],
+                                    torch.ones(count, prefix_length, dtype=inputs["attention_mask"].dtype),
+                                    inputs["attention_mask"][:, 1:]], dim=1)
+        
+        return {"input_ids": input_ids, "attention_mask": attention_mask}
+    
+    def generate_embeddings(self, texts: List[str]) -> Iterator[Tuple[int, np.ndarray]]:
+        """Generate embeddings for the given texts using multilingual-e5-large.
+        
+        Yields (index, embedding) pairs as soon as each batch is done, so in batch order
+        rather than in the order of the texts.
+        """
+        if not texts:
+            return
+        
+        inputs = self.tokenize(texts)
+        
+        # Batch texts of similar length together so short texts aren't padded to the longest one.
+        # Longest first, so running out of device memory shows up on the first batch.
+        lengths = inputs["attention_mask"].sum(dim=1)
+        order = lengths.argsort(descending=True)
         
-        # Tokenize and generate embedding
-        inputs = self.tokenizer(text, return_tensors="pt", padding=True, truncation=True, max_length=512)
-        inputs = {k: v.to(self.device) for k, v in inputs.items()}
+        if self.device.type == "cuda":
+            # Only warm up the buckets the batches will hit; each batch's longest text is its first
+            self.warmup(sorted({self.bucket_width(int(lengths[order[start]]))
+                                for start in range(0, len(texts), self.batch_size)}))
         
-        with torch.no_grad():
-            outputs = self.model(**inputs)
-            # Use mean pooling on the token embeddings
-            embeddings = self.mean_pooling(outputs.last_hidden_state, inputs['attention_mask'])
-            # Normalize embeddings
-            embeddings = torch.nn.functional.normalize(embeddings, p=2, dim=1)
+        pad_values = {"input_ids": self.tokenizer.pad_token_id, "attention_mask": 0}
+        
+        def load_batch(start):
+            rows = order[start:start + self.batch_size]
+            longest = int(lengths[rows].max())
+            if self.device.type == "cuda":
+                # Keep input shapes fixed for the compiled model: pad to the smallest width bucket
+                # and fill the last batch by repeating its last row (the extra outputs are dropped)
+                width = self.bucket_width(longest)
+                batch_rows = torch.cat([rows, rows[-1:].expand(self.batch_size - len(rows))])
+            else:
+                # Trim padding beyond the longest text in the batch, keeping a multiple of 8
+                # so half precision matmuls stay on the tensor core path
+                width = -(-longest // 8) * 8
+                batch_rows = rows
+            batch = {k: v[batch_rows, :width] for k, v in inputs.items()}
+            batch = {k: torch.nn.functional.pad(v, (0, width - v.shape[1]), value=pad_values[k])
+                     for k, v in batch.items()}
+            return rows, {k: v.to(self.device) for k, v in batch.items()}
         
-        return embeddings[0].cpu().tolist()
+        # Run the model on mini-batches to keep the device busy without exhausting its memory
+        for start in range(0, len(texts), self.batch_size):
+            rows, batch = load_batch(start)
+            # zip stops at the real rows, dropping outputs of rows repeated to fill the batch
+            yield from zip(rows.tolist(), self.embed_batch(batch))
+    
+    @torch.inference_mode()
+    def embed_batch(self, batch: Dict[str, torch.Tensor]) -> np.ndarray:
+        """Run the model on a tokenized batch and return its normalized embeddings."""
+        outputs = self.model(**batch, return_dict=True)
+        # Pool in fp32 to avoid precision loss when summing half precision hidden states
+        last_hidden_state = outputs.last_hidden_state.float()
+        # Use mean pooling on the token embeddings
+        embeddings = self.mean_pooling(last_hidden_state, batch['attention_mask'])
+        # Normalize embeddings in place (same as F.normalize, without allocating a new tensor)
+        embeddings.div_(embeddings.norm(dim=1, keepdim=True).clamp_min(1e-12))
+        return embeddings.cpu().numpy()
     
     def mean_pooling(self, token_embeddings, attention_mask):
         """Apply mean pooling to get sentence embedding."""
@@ -72,36 +192,92 @@ class EmbeddingBuilder:
         embedding_path = self.embeddings_dir / relative_path.parent / f"{relative_path.stem}.json"
         return embedding_path
     
-    def should_process_file(self, md_path: Path, embedding_path: Path) -> bool:
-        """Check if the file needs to be processed based on shasum."""
+    def should_process_file(self, md_path: Path, embedding_path: Path) -> Tuple[bool, str]:
+        """Check if the file needs to be processed based on shasum.
+        
+        Returns whether the file needs processing and its current shasum. The shasum is taken
+        from the mtime cache instead of hashing the file when its modification time and size
+        are unchanged.
+        """
+        relative_path = str(md_path.relative_to(self.docs_dir))
+        # Stat before hashing, so a file modified in between gets rechecked next run
+        stat = md_path.stat()
+        cached = self.mtime_cache.get(relative_path)
+        if cached is not None and cached[:2] == (stat.st_mtime_ns, stat.st_size):
+            current_shasum = cached[2]
+        else:
+            current_shasum = self.calculate_shasum(md_path)
+        # Always refresh the entry, so a file whose mtime changed without its content changing
+        # (e.g. git checkout) takes the fast path on the next run
+        self.mtime_cache[relative_path] = (stat.st_mtime_ns, stat.st_size, current_shasum)
+        
         if not embedding_path.exists():
-            return True
+            return True, current_shasum
         
         # Load existing embedding file
         try:
-            with open(embedding_path, "r", encoding="utf-8") as f:
-                existing_data = json.load(f)
+            existing_data = orjson.loads(embedding_path.read_bytes())
             
             # Compare shasum
-            current_shasum = self.calculate_shasum(md_path)
-            return existing_data.get("shasum") != current_shasum
-        except (json.JSONDecodeError, KeyError, IOError):
+            return existing_data.get("shasum") != current_shasum, current_shasum
+        except (orjson.JSONDecodeError, KeyError, IOError):
             # If there's any issue reading the existing file, reprocess
-            return True
+            return True, current_shasum
     
-    def process_markdown_file(self, md_path: Path) -> None:
-        """Process a single markdown file and generate its embedding."""
-        print(f"Processing: {md_path.relative_to(self.docs_dir)}")
+    def load_mtime_cache(self) -> None:
+        """Load the mtime cache written by the previous run, if any."""
+        self.mtime_cache = {}
+        if self.mtime_cache_path is None:
+            return
         
-        # Read the entire content for embedding
-        with open(md_path, "r", encoding="utf-8") as f:
-            content = f.read()
+        try:
+            data = orjson.loads(self.mtime_cache_path.read_bytes())
+        except (orjson.JSONDecodeError, IOError):
+            return
         
-        # Generate embedding
-        shasum = self.calculate_shasum(md_path)
-        headline = self.get_headline(md_path)
-        embedding = self.generate_embedding(content)
+        # Ignore anything that isn't a {path: [mtime_ns, size, shasum]} entry
+        if isinstance(data, dict):
+            self.mtime_cache = {
+                path: tuple(entry) for path, entry in data.items()
+                if isinstance(entry, list) and len(entry) == 3
+                and type(entry[0]) is int and type(entry[1]) is int and isinstance(entry[2], str)
+            }
+    
+    def save_mtime_cache(self, md_files: List[Path]) -> None:
+        """Save the mtime cache, keeping only entries of existing markdown files."""
+        if self.mtime_cache_path is None:
+            return
         
+        md_relative_paths = {str(md_path.relative_to(self.docs_dir)) for md_path in md_files}
+        self.mtime_cache_path.parent.mkdir(parents=True, exist_ok=True)
+        self.mtime_cache_path.write_bytes(orjson.dumps(
+            {path: entry for path, entry in self.mtime_cache.items() if path in md_relative_paths}))
+    
+    def process_markdown_files(self, md_paths: List[Path], shasums: List[str]) -> None:
+        """Generate embeddings for a list of markdown files in batches and save them.
+        
+        The shasums are the ones already computed by should_process_file.
+        """
+        contents = []
+        headlines = []
+        for md_path in md_paths:
+            print(f"Processing: {md_path.relative_to(self.docs_dir)}")
+            
+            # Read the entire content for embedding along with its headline
+            content, headline = self.read_markdown_file(md_path)
+            contents.append(content)
+            headlines.append(headline)
+        
+        # Generate embeddings, saving each batch on background threads while the next one runs
+        with ThreadPoolExecutor(max_workers=4) as writer:
+            futures = [writer.submit(self.save_embedding, md_paths[i], embedding, shasums[i], headlines[i])
+                       for i, embedding in self.generate_embeddings(contents)]
+            for future in futures:
+                # Re-raise any error from saving
+                future.result()
+    
+    def save_embedding(self, md_path: Path, embedding: np.ndarray, shasum: str, headline: str) -> None:
+        """Save the embedding of a markdown file along with its metadata."""
         # Prepare output data
         output_data = {
             "embeddings": {
@@ -115,29 +291,44 @@ class EmbeddingBuilder:
         embedding_path = self.get_embedding_path(md_path)
         embedding_path.parent.mkdir(parents=True, exist_ok=True)
         
-        # Save embedding
-        with open(embedding_path, "w", encoding="utf-8") as f:
-            json.dump(output_data, f, ensure_ascii=False, indent=2)
+        # Save embedding as compact UTF-8 JSON; orjson serializes the numpy array directly in C
+        embedding_path.write_bytes(orjson.dumps(output_data, option=orjson.OPT_SERIALIZE_NUMPY))
         
         print(f"  → Saved to: {embedding_path.relative_to(self.embeddings_dir)}")
     
+    def walk_files(self, root: Path, suffix: str) -> Iterator[str]:
+        """Recursively yield the paths, relative to root, of files ending in suffix.
+        
+        Uses os.scandir, whose entries know their type from the directory listing itself,
+        so no Path objects or extra stat calls are needed per entry.
+        """
+        stack = [(str(root), "")]
+        while stack:
+            directory, relative_directory = stack.pop()
+            with os.scandir(directory) as entries:
+                for entry in entries:
+                    relative_path = os.path.join(relative_directory, entry.name)
+                    # Like rglob, don't descend into symlinked directories
+                    if entry.is_dir(follow_symlinks=False):
+                        stack.append((entry.path, relative_path))
+                    elif entry.name.endswith(suffix) and entry.is_file():
+                        yield relative_path
+    
     def find_all_markdown_files(self) -> List[Path]:
         """Find all markdown files in the docs directory."""
-        return list(self.docs_dir.rglob("*.md"))
+        return [self.docs_dir / relative_path for relative_path in self.walk_files(self.docs_dir, ".md")]
     
     def find_orphaned_embeddings(self, md_files: List[Path]) -> List[Path]:
         """Find embedding files that no longer have corresponding markdown files."""
-        md_relative_paths = {md_path.relative_to(self.docs_dir).parent / f"{md_path.stem}.json" 
+        md_relative_paths = {str(md_path.relative_to(self.docs_dir).parent / f"{md_path.stem}.json")
                              for md_path in md_files}
         
-        orphaned = []
-        if self.embeddings_dir.exists():
-            for embedding_path in self.embeddings_dir.rglob("*.json"):
-                relative_path = embedding_path.relative_to(self.embeddings_dir)
-                if relative_path not in md_relative_paths:
-                    orphaned.append(embedding_path)
+        if not self.embeddings_dir.exists():
+            return []
         
-        return orphaned
+        embedding_paths = set(self.walk_files(self.embeddings_dir, ".json"))
+        return [self.embeddings_dir / relative_path
+                for relative_path in embedding_paths - md_relative_paths]
     
     def delete_orphaned_embeddings(self, orphaned: List[Path]) -> None:
         """Delete embedding files for deleted markdown files."""
@@ -171,18 +362,23 @@ class EmbeddingBuilder:
         md_files = self.find_all_markdown_files()
         print(f"Found {len(md_files)} markdown files")
         
-        # Process each markdown file (only if changed)
-        processed_count = 0
-        skipped_count = 0
+        self.load_mtime_cache()
         
-        for md_path in md_files:
-            embedding_path = self.get_embedding_path(md_path)
-            
-            if self.should_process_file(md_path, embedding_path):
-                self.process_markdown_file(md_path)
-                processed_count += 1
-            else:
-                skipped_count += 1
+        # Collect markdown files that need (re)processing. Hashing releases the GIL,
+        # so checking files on a thread pool scales with disk and core count.
+        with ThreadPoolExecutor(max_workers=os.cpu_count()) as executor:
+            results = list(executor.map(
+                lambda md_path: self.should_process_file(md_path, self.get_embedding_path(md_path)),
+                md_files))
+        to_process = [md_path for md_path, (needed, _) in zip(md_files, results) if needed]
+        to_process_shasums = [shasum for needed, shasum in results if needed]
+        processed_count = len(to_process)
+        skipped_count = len(md_files) - processed_count
+        
+        # Process changed files in batches
+        if to_process:
+            self.process_markdown_files(to_process, to_process_shasums)
+        self.save_mtime_cache(md_files)
         
         print(f"\nProcessed: {processed_count} files")
         print(f"Skipped (unchanged): {skipped_count} files")
@@ -197,5 +393,6 @@ class EmbeddingBuilder:
 
 
 if __name__ == "__main__":
-    builder = EmbeddingBuilder()
+    builder = EmbeddingBuilder(quantize_cpu=os.environ.get("QUANTIZE_CPU") == "1",
+                               cache_dir=os.environ.get("CACHE_DIR"))
     builder.run()